@@ -1,18 +1,36 @@
 
 
+import calendar
 import csv
+import hashlib
+import html
+import json
 import urllib.request
 import io
+import itertools
+import ahocorasick
 import feedparser
 import datetime
-import pytz
+import requests
 import sys
-import time
 import re
 import os
 import socket
-from urllib.parse import urlparse
-from jinja2 import Environment, FileSystemLoader
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+from urllib.parse import urljoin, urlparse
+from zoneinfo import ZoneInfo
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from requests.adapters import HTTPAdapter, Retry
+
+# キャッシュの読み書きは orjson があれば使い、なければ標準の json で行う
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # 設定
 # 修正箇所: ローカルファイルの指定から、公開されたスプレッドシート(CSV)のURLに変更
@@ -21,10 +39,62 @@ template_file = 'template.html'
 output_dir = 'docs'
 max_entries = 10 
 new_threshold_hours = 24
+NEW_THRESHOLD_SECONDS = new_threshold_hours * 3600
+# 出力する概要の最大文字数（全文HTMLをそのままテンプレートに渡さない）
+summary_max_length = 500
 timeout_seconds = 15
+user_agent = 'Mozilla/5.0 (compatible; MyRSSReader/1.0)'
+# フィードを並列に取得するスレッド数の上限
+max_workers = 16
+# 前回取得したフィードの内容とETag/Last-Modified・本文のハッシュを保存するディレクトリ
+cache_dir = '.feed_cache'
+cache_version = 8
+# コンパイル済みテンプレートを保存するディレクトリ（次回以降のテンプレートの解析を省く）
+template_cache_dir = '.jinja_cache'
 
 socket.setdefaulttimeout(timeout_seconds)
 
+# タイムゾーンは毎回作らずにモジュールで1回だけ用意する
+UTC = datetime.timezone.utc
+JST = ZoneInfo('Asia/Tokyo')
+
+# 同じホストのフィードでTCP/TLS接続を使い回すため、全スレッドで1つのセッションを共有する
+# 接続プールはスレッド数に合わせ、一時的なサーバーエラーは間隔を空けて再試行する
+# Retry-After に従うと数時間待たされることがあるため無視し、すぐには解除されない429も再試行しない
+# 応答待ちのタイムアウト（read）は再試行せず、接続失敗の再試行も1回までに抑える
+# （フィードの取得は最も遅いフィードで全体の時間が決まるため、1回のリクエストは timeout_seconds 程度で打ち切りたい）
+SESSION = requests.Session()
+SESSION.headers['User-Agent'] = user_agent
+http_adapter = HTTPAdapter(
+    pool_connections=max_workers,
+    pool_maxsize=max_workers,
+    max_retries=Retry(
+        total=2,
+        connect=1,
+        read=0,
+        other=0,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+        respect_retry_after_header=False
+    )
+)
+SESSION.mount('http://', http_adapter)
+SESSION.mount('https://', http_adapter)
+
+# 記事本文から画像URLを抜き出す正規表現（記事ごとに使うため事前にコンパイルしておく）
+# 引用符以外の文字に限定して、引用符をまたいだバックトラックを防ぐ
+IMG_SRC_RE = re.compile(r'<img[^>]+src=["\']([^"\']+?)["\']', re.IGNORECASE)
+HTML_TAG_RE = re.compile(r'<[^>]*>')
+PARTIAL_ENTITY_RE = re.compile(r'&[^;\s]*$')
+
+# 並列取得時にログ出力が混ざらないようにするためのロック
+print_lock = threading.Lock()
+
+def log(message):
+    with print_lock:
+        print(message)
+
 # 修正箇所: YAMLファイル読み込み関数を廃止し、CSVをURLから直接読み込む関数を新設
 def load_config_from_csv(url):
     print("Loading config from Google Sheets CSV...")
@@ -91,6 +161,8 @@ def load_config_from_csv(url):
     config['pages'] = list(pages_dict.values())
     return config
 
+# 同じリンクが何度も現れるため、結果をキャッシュしておく
+@lru_cache(maxsize=None)
 def get_domain(url):
     try:
         parsed = urlparse(url)
@@ -99,17 +171,15 @@ def get_domain(url):
         return ""
 
 def parse_date(entry):
-    if hasattr(entry, 'published_parsed') and entry.published_parsed:
-        return datetime.datetime.fromtimestamp(time.mktime(entry.published_parsed), pytz.utc)
-    elif hasattr(entry, 'updated_parsed') and entry.updated_parsed:
-        return datetime.datetime.fromtimestamp(time.mktime(entry.updated_parsed), pytz.utc)
-    return None
+    # feedparserの *_parsed はUTCのstruct_timeなので、calendar.timegmでそのままUNIX時刻にする
+    # （time.mktimeはローカル時刻として解釈するため、実行環境のタイムゾーン分ずれる）
+    parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+    return calendar.timegm(parsed) if parsed else None
 
-def format_relative_time(dt_obj, now_utc):
-    if not dt_obj:
+def format_relative_time(timestamp, now_ts):
+    if not timestamp:
         return ""
-    diff = now_utc - dt_obj
-    seconds = diff.total_seconds()
+    seconds = now_ts - timestamp
     if seconds < 3600:
         return f"{int(seconds // 60)}分前"
     elif seconds < 86400:
@@ -119,128 +189,368 @@ def format_relative_time(dt_obj, now_utc):
     else:
         return f"{int(seconds // 86400)}日前"
 
-def extract_image(entry):
-    if 'media_content' in entry:
-        for media in entry.media_content:
-            if 'image' in media.get('type', '') or 'medium' in media and media['medium'] == 'image':
-                return media['url']
-    if 'media_thumbnail' in entry:
-        return entry.media_thumbnail[0]['url']
-    if 'links' in entry:
-        for link in entry.links:
-            if link.get('rel') == 'enclosure' and 'image' in link.get('type', ''):
-                return link['href']
-    content = entry.get('summary', '') + entry.get('content', [{'value': ''}])[0]['value']
-    img_match = re.search(r'<img[^>]+src=["\'](.*?)["\']', content)
+def is_image_media(media):
+    # type が空（None）の場合や medium だけが指定されている場合も考慮する
+    return ('image' in (media.get('type') or '')) or (media.get('medium') == 'image')
+
+def is_image_enclosure(link):
+    return link.get('rel') == 'enclosure' and 'image' in (link.get('type') or '')
+
+def extract_image(entry, summary, content, feed_link):
+    # 相対URLは feed_link（リダイレクト後のフィードのURL）を基準に絶対URLにして返す
+    # URLが欠けている要素は飛ばし、最初に見つかった画像を使う
+    media_url = next(
+        (media['url'] for media in entry.get('media_content') or [] if media.get('url') and is_image_media(media)),
+        None
+    )
+    if media_url:
+        return urljoin(feed_link, media_url)
+    media_thumbnail = entry.get('media_thumbnail')
+    if media_thumbnail and media_thumbnail[0].get('url'):
+        return urljoin(feed_link, media_thumbnail[0]['url'])
+    enclosure_url = next(
+        (link['href'] for link in entry.get('links') or [] if link.get('href') and is_image_enclosure(link)),
+        None
+    )
+    if enclosure_url:
+        return urljoin(feed_link, enclosure_url)
+    # 概要と本文は連結せず、概要→本文の順に個別に検索する
+    # 本文中の相対URLは、見つかった要素の xml:base（feedparserが要素ごとに記録する base）を基準に解決する
+    img_match = IMG_SRC_RE.search(summary)
     if img_match:
-        return img_match.group(1)
+        base = (entry.get('summary_detail') or {}).get('base')
+    else:
+        img_match = IMG_SRC_RE.search(content)
+        base = entry['content'][0].get('base') if img_match else None
+    if img_match:
+        # HTMLから抜き出した値は &amp; などがエスケープされたままなので元に戻す
+        # （出力時はテンプレートの自動エスケープがかかるため、ここで戻さないと二重にエスケープされる）
+        return urljoin(base or feed_link, html.unescape(img_match.group(1)))
     return None
 
-def is_ng_content(entry, ng_keywords):
-    if not ng_keywords:
+def is_ng_text(text, ng_automaton):
+    # NGワードのオートマトン（build_keyword_automaton で作成）はページごとに1回だけ作り、
+    # 記事ごとの判定はどれか1つでも見つかった時点で打ち切る
+    if ng_automaton is None:
         return False
-    text = (entry.get('title', '') + entry.get('summary', '')).lower()
-    for keyword in ng_keywords:
-        if keyword.lower() in text:
-            return True
-    return False
-
-def process_entry(entry, feed_title, feed_link, now_utc):
-    dt = parse_date(entry)
-    is_new = False
-    rel_time = ""
-    timestamp = 0
-    
-    if dt:
-        if (now_utc - dt).total_seconds() < (new_threshold_hours * 3600):
-            is_new = True
-        rel_time = format_relative_time(dt, now_utc)
-        timestamp = dt.timestamp()
-    
+    return next(ng_automaton.iter(text), None) is not None
+
+def is_ng_content(entry, ng_automaton):
+    return is_ng_text(entry['_search_text'], ng_automaton)
+
+def make_summary_text(html_text):
+    # タグを除いて空白をまとめる（文字参照はテンプレートの striptags で展開されるため残す）
+    return ' '.join(HTML_TAG_RE.sub(' ', html_text).split())
+
+def truncate_summary(text):
+    if len(text) <= summary_max_length:
+        return text
+    # 途中で切れた文字参照（&amp; など）は残さない
+    return PARTIAL_ENTITY_RE.sub('', text[:summary_max_length]).rstrip() + '…'
+
+def update_time_fields(item, now_ts):
+    # 新着判定と相対時刻はビルド時刻に依存するため、キャッシュ再利用時にも計算し直す
+    # 記事ごとの計算はUNIX時刻（float）同士の引き算だけで済ませる
+    timestamp = item['timestamp']
+    item['is_new'] = bool(timestamp) and (now_ts - timestamp) < NEW_THRESHOLD_SECONDS
+    item['relative_time'] = format_relative_time(timestamp, now_ts)
+    return item
+
+def build_keyword_automaton(keywords):
+    # 複数のキーワードを1回の走査でまとめて検出するためのAho-Corasickオートマトンを作る
+    # 小文字化すると同じになるキーワードもあるため、値には元のキーワードのリストを持たせる
+    automaton = ahocorasick.Automaton()
+    for keyword in keywords:
+        keyword_lower = keyword.lower()
+        if not keyword_lower:
+            continue
+        originals = automaton.get(keyword_lower, None)
+        if originals is None:
+            automaton.add_word(keyword_lower, [keyword])
+        elif keyword not in originals:
+            originals.append(keyword)
+    if len(automaton) == 0:
+        return None
+    automaton.make_automaton()
+    return automaton
+
+def ng_keywords_key(keywords):
+    # 判定結果は小文字化したキーワードの集合だけで決まるため、これをキャッシュのキーにする
+    return frozenset(keyword.lower() for keyword in keywords if keyword)
+
+def get_ng_automaton(ng_automatons, ng_key):
+    # NG判定のオートマトンは ng_keywords_key ごとに1回だけ作り、取得時の間引きとページ生成で共有する
+    if ng_key not in ng_automatons:
+        ng_automatons[ng_key] = build_keyword_automaton(ng_key)
+    return ng_automatons[ng_key]
+
+def match_keywords(automaton, text):
+    matched = set()
+    for _, originals in automaton.iter(text):
+        matched.update(originals)
+    return matched
+
+def process_entry(entry, feed_title, feed_link, now_ts, drop_automatons=None):
     summary = entry.get('summary', entry.get('description', ''))
-    content = entry.get('content', [{'value': ''}])[0]['value']
+    content = entry['content'][0]['value'] if entry.get('content') else ''
     text_content = content if len(content) > len(summary) else summary
-    image_url = extract_image(entry)
+    title = entry.get('title', 'No Title')
+    summary_text = make_summary_text(text_content)
+    # NGワード・キーワード判定用の小文字テキスト（記事ごとに1回だけ作成する）
+    # 判定には切り詰める前の全文を使い、タイトルと概要の境目をまたいで一致しないよう改行で区切る
+    search_text = (title + '\n' + summary_text).lower()
+    # 記事を使う全てのページでNG判定により除外される記事は、画像の抽出などを行わずに捨てる
+    if drop_automatons and all(is_ng_text(search_text, automaton) for automaton in drop_automatons):
+        return None
+    
+    timestamp = parse_date(entry) or 0
+    image_url = extract_image(entry, summary, content, feed_link)
 
-    return {
-        'title': entry.get('title', 'No Title'),
+    return update_time_fields({
+        'title': title,
         'link': entry.get('link', '#'),
-        'is_new': is_new,
-        'relative_time': rel_time,
-        'summary': text_content,
+        'summary': truncate_summary(summary_text),
         'image': image_url,
         'timestamp': timestamp,
-        'source_title': feed_title
+        'source_title': feed_title,
+        # 先頭が '_' のキーはテンプレートでは使わない内部用の値
+        '_search_text': search_text
+    }, now_ts)
+
+def get_cache_path(url):
+    # URLをそのままファイル名にできないため、ハッシュ値をファイル名にする
+    return os.path.join(cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def load_feed_cache(url):
+    try:
+        with open(get_cache_path(url), 'rb') as f:
+            cache = json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+    # JSONとしては正しくても、中身が辞書でなければ壊れたキャッシュとして扱う
+    if not isinstance(cache, dict):
+        return None
+    if cache.get('version') != cache_version or cache.get('url') != url:
+        return None
+    return cache
+
+def save_feed_cache(url, cache):
+    cache['version'] = cache_version
+    cache['url'] = url
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = get_cache_path(url)
+        with open(cache_path + '.tmp', 'wb') as f:
+            f.write(json_dumps(cache))
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as e:
+        log(f"  Error saving cache for {url}: {e}")
+
+def feed_from_cache(cache, title_override, now_ts):
+    feed_title = title_override if title_override else cache['feed_title']
+    entries = cache['entries']
+    for entry in entries:
+        entry['source_title'] = feed_title
+        update_time_fields(entry, now_ts)
+    return {
+        'title': feed_title,
+        'domain': cache['domain'],
+        'entries': entries
     }
 
-def fetch_all_feeds(config):
-    all_urls = set()
+def fetch_feed(url, title_override, now_ts, ng_filter=None):
+    log(f"  Fetching: {url}...")
+    # ng_filter は (NG設定の署名, 記事を捨てる判定に使うオートマトンのリスト) または None
+    ng_signature, drop_automatons = ng_filter or (None, None)
+    cache = load_feed_cache(url)
+    # キャッシュに残る記事はNG設定によって変わるため、設定が前回と違うキャッシュは使わない
+    if cache and cache.get('ng_filter') != ng_signature:
+        cache = None
+    try:
+        # 前回のETag/Last-Modifiedを送り、更新がなければ304（本文なし）を受け取る
+        headers = {}
+        if cache and cache.get('etag'):
+            headers['If-None-Match'] = cache['etag']
+        if cache and cache.get('modified'):
+            headers['If-Modified-Since'] = cache['modified']
+        response = SESSION.get(url, headers=headers, timeout=timeout_seconds)
+
+        if cache and response.status_code == 304:
+            log(f"  Not modified: {url}")
+            return feed_from_cache(cache, title_override, now_ts)
+
+        response.raise_for_status()
+        etag = response.headers.get('ETag')
+        modified = response.headers.get('Last-Modified')
+        
+        # 304に対応していないサーバーでも、本文が前回と同じならパースせずに保存済みの記事を使う
+        content_sha1 = hashlib.sha1(response.content).hexdigest()
+        if cache and cache.get('sha1') == content_sha1:
+            log(f"  Unchanged: {url}")
+            if (cache.get('etag'), cache.get('modified')) != (etag, modified):
+                cache['etag'] = etag
+                cache['modified'] = modified
+                save_feed_cache(url, cache)
+            return feed_from_cache(cache, title_override, now_ts)
+
+        # 取得済みの本文をfeedparserに渡す（文字コード判定と相対リンクの基準URL用にヘッダーも渡す）
+        # HTMLのサニタイズと相対URL解決はfeedparser内で最も重い処理のため行わない
+        # （出力時はテンプレート側の自動エスケープで無害化し、画像URLだけを自前で解決する）
+        d = feedparser.parse(
+            response.content,
+            response_headers={
+                'content-type': response.headers.get('Content-Type', ''),
+                'content-location': response.url
+            },
+            sanitize_html=False,
+            resolve_relative_uris=False
+        )
+
+        feed_title = title_override if title_override else d.feed.get('title', 'Unknown Feed')
+        # ファビコンのURLはテンプレート側で組み立てるため、ここではドメインだけを持つ
+        domain = get_domain(d.feed.get('link', url))
+        
+        entries = []
+        for entry in islice(d.entries, max_entries):
+            # 相対URLはリダイレクト後の最終的なURLを基準に解決する
+            processed = process_entry(entry, feed_title, response.url, now_ts, drop_automatons)
+            if processed is not None:
+                entries.append(processed)
+        
+        save_feed_cache(url, {
+            'etag': etag,
+            'modified': modified,
+            'sha1': content_sha1,
+            'feed_title': d.feed.get('title', 'Unknown Feed'),
+            'domain': domain,
+            'ng_filter': ng_signature,
+            'entries': entries
+        })
+        
+        return {
+            'title': feed_title,
+            'domain': domain,
+            'entries': entries
+        }
+    except Exception as e:
+        log(f"  Error fetching {url}: {e}")
+        return None
+
+def fetch_all_feeds(config, now_ts, ng_automatons):
+    # 同じURLが複数のページに登録されていても1回だけ取得する（URL単位で重複排除）
+    # ウォッチページはここで取得した全フィードを横断検索するため、追加の取得は不要
+    # タイトルの上書き指定は、最初に現れた空でないものを採用する
+    all_urls = {}
     for page in config.get('pages', []):
         for feed in page.get('feeds', []):
             clean_url = feed['url'].strip()
-            all_urls.add((clean_url, feed.get('title')))
+            if not all_urls.get(clean_url):
+                all_urls[clean_url] = feed.get('title')
+    
+    # 記事を使うのは、そのフィードを登録した通常ページと、キーワードを持つ全てのウォッチページ
+    # これら全てのNG判定で除外される記事は、取得時点で捨てて以降の処理を省く
+    watch_ng_keys = {
+        ng_keywords_key(watch.get('ng_keywords', []))
+        for watch in config.get('watches', []) if ng_keywords_key(watch.get('keywords', []))
+    }
+    consumer_ng_keys = {}
+    for page in config.get('pages', []):
+        page_ng_key = ng_keywords_key(page.get('ng_keywords', []))
+        for feed in page.get('feeds', []):
+            consumer_ng_keys.setdefault(feed['url'].strip(), set(watch_ng_keys)).add(page_ng_key)
+    
+    ng_filters = {}
+    for url, ng_keys in consumer_ng_keys.items():
+        # NGキーワードを持たないページが1つでもあれば、どの記事も捨てられない
+        if frozenset() in ng_keys:
+            ng_filters[url] = None
+            continue
+        ng_filters[url] = (
+            sorted(sorted(ng_key) for ng_key in ng_keys),
+            [get_ng_automaton(ng_automatons, ng_key) for ng_key in ng_keys]
+        )
     
     print(f"Fetching {len(all_urls)} unique feeds...")
-    now_utc = datetime.datetime.now(pytz.utc)
-    results = {}
-    user_agent = 'Mozilla/5.0 (compatible; MyRSSReader/1.0)'
-
-    for url, title_override in all_urls:
-        print(f"  Fetching: {url}...")
-        try:
-            d = feedparser.parse(url, agent=user_agent)
-            if d.bozo:
-                if isinstance(d.bozo_exception, (socket.timeout, socket.error)):
-                     raise d.bozo_exception
-
-            feed_title = title_override if title_override else d.feed.get('title', 'Unknown Feed')
-            domain = get_domain(d.feed.get('link', url))
-            favicon = f"https://www.google.com/s2/favicons?domain={domain}"
-            
-            entries = []
-            for entry in d.entries[:max_entries]:
-                processed = process_entry(entry, feed_title, url, now_utc)
-                entries.append(processed)
-            
-            results[url] = {
-                'title': feed_title,
-                'favicon': favicon,
-                'entries': entries
-            }
-        except Exception as e:
-            print(f"  Error fetching {url}: {e}")
-            results[url] = None
+    # 結果の並び順を設定ファイルの登録順に揃える
+    results = dict.fromkeys(all_urls)
+
+    # フィード取得は通信待ちが大半のため、スレッドプールで並列に取得する
+    # ハングした接続でスレッドが塞がらないよう、各リクエストには timeout_seconds を設定している
+    # 応答のないサーバーは再試行しないため1回の待ちで打ち切り、再試行は接続失敗（1回まで）と5xxだけに限る
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(all_urls)))) as executor:
+        futures = {
+            executor.submit(fetch_feed, url, title_override, now_ts, ng_filters[url]): url
+            for url, title_override in all_urls.items()
+        }
+        for done_count, future in enumerate(as_completed(futures), 1):
+            url = futures[future]
+            results[url] = future.result()
+            log(f"  Done ({done_count}/{len(futures)}): {url}")
             
     return results
 
+def write_page(template, output_path, **context):
+    # 一時ファイルに書き出してから置き換え、途中で失敗しても書きかけのHTMLを残さない
+    # HTML全体をメモリ上に組み立てず、生成しながら大きめのバッファで書き出す
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        template.stream(**context).dump(f)
+    os.replace(tmp_path, output_path)
+
 def main():
     os.makedirs(output_dir, exist_ok=True)
     # 修正箇所: 新設したCSV読み込み関数を呼び出す
     config = load_config_from_csv(csv_url)
     
-    navigation = []
-    for watch in config.get('watches', []):
-        if not watch.get('hidden', False):
-            navigation.append({'page_title': watch['page_title'], 'filename': watch['filename']})
-    for page in config.get('pages', []):
-        if not page.get('hidden', False):
-            navigation.append({'page_title': page['page_title'], 'filename': page['filename']})
+    # ナビゲーションはウォッチページ→通常ページの順に、非表示のものを除いて並べる
+    navigation = [
+        {'page_title': p['page_title'], 'filename': p['filename']}
+        for p in itertools.chain(config.get('watches', []), config.get('pages', []))
+        if not p.get('hidden', False)
+    ]
     
-    all_feeds_data = fetch_all_feeds(config)
+    # ビルド時刻は1回だけ取得し、新着判定と最終更新表示で共有する
+    now_utc = datetime.datetime.now(UTC)
+    # NGキーワード集合ごとのオートマトン（取得時の間引きとページ生成の両方で同じものを使う）
+    ng_automatons = {}
+    all_feeds_data = fetch_all_feeds(config, now_utc.timestamp(), ng_automatons)
     
-    jst = pytz.timezone('Asia/Tokyo')
-    now_str = datetime.datetime.now(jst).strftime('%m/%d %H:%M')
+    now_str = now_utc.astimezone(JST).strftime('%m/%d %H:%M')
     
-    env = Environment(loader=FileSystemLoader('.', encoding='utf-8'))
+    # テンプレートは実行中に変わらないため、ページごとの更新チェック（stat）を行わない
+    # フィードのHTMLはサニタイズしていないため、出力時に必ずエスケープする
+    os.makedirs(template_cache_dir, exist_ok=True)
+    env = Environment(
+        loader=FileSystemLoader('.', encoding='utf-8'),
+        bytecode_cache=FileSystemBytecodeCache(template_cache_dir),
+        autoescape=True,
+        auto_reload=False,
+        cache_size=-1
+    )
+    # 全ページ共通の値はグローバル変数として1回だけ登録する
+    env.globals['navigation'] = navigation
+    env.globals['last_updated'] = now_str
     template = env.get_template(template_file)
     
     # 3. 通常ページの生成
+    # 同じフィードを同じNGキーワードで絞り込む結果は、ページをまたいで使い回す
+    ng_filter_cache = {}
     for page_config in config.get('pages', []):
         target_filename = page_config['filename']
         print(f"Building Page: {target_filename}")
         
         page_config['is_topic'] = False 
-        ng_keywords = page_config.get('ng_keywords', [])
+        ng_key = ng_keywords_key(page_config.get('ng_keywords', []))
         
         page_entries = [] 
         page_feeds = []   
@@ -250,113 +560,144 @@ def main():
             source_data = all_feeds_data.get(url)
             
             if source_data:
-                valid_entries = [e for e in source_data['entries'] if not is_ng_content(e, ng_keywords)]
+                cached = ng_filter_cache.get((url, ng_key))
+                if cached is None:
+                    ng_automaton = get_ng_automaton(ng_automatons, ng_key)
+                    # NG判定と新着件数の集計を1回の走査で行う
+                    valid_entries = []
+                    new_count = 0
+                    for e in source_data['entries']:
+                        if is_ng_content(e, ng_automaton):
+                            continue
+                        valid_entries.append(e)
+                        new_count += e['is_new']
+                    cached = ng_filter_cache[(url, ng_key)] = (valid_entries, new_count)
+                valid_entries, new_count = cached
+                
+                for e in valid_entries:
+                    e_copy = e.copy()
+                    e_copy['domain'] = source_data['domain']
+                    e_copy['source_title'] = source_data['title']
+                    page_entries.append(e_copy)
+                
                 if valid_entries:
-                    for e in valid_entries:
-                        e_copy = e.copy()
-                        e_copy['favicon'] = source_data['favicon']
-                        e_copy['source_title'] = source_data['title']
-                        page_entries.append(e_copy)
-                    
                     page_feeds.append({
                         'title': source_data['title'],
-                        'favicon': source_data['favicon'],
+                        'domain': source_data['domain'],
                         'entries': valid_entries,
                         'total_count': len(valid_entries),
-                        'new_count': sum(1 for e in valid_entries if e['is_new']),
-                        'has_new': any(e['is_new'] for e in valid_entries)
+                        'new_count': new_count,
+                        'has_new': new_count > 0
                     })
         
-        page_entries.sort(key=lambda x: x['timestamp'], reverse=True)
+        page_entries.sort(key=itemgetter('timestamp'), reverse=True)
         
         output_path = os.path.join(output_dir, target_filename)
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(template.render(
-                navigation=navigation,
-                current_page=page_config,
-                entries=page_entries,
-                feeds=page_feeds,
-                topics=[], 
-                last_updated=now_str
-            ))
+        write_page(
+            template,
+            output_path,
+            current_page=page_config,
+            entries=page_entries,
+            feeds=page_feeds,
+            topics=[]
+        )
 
     # 4. ウォッチページの生成
+    # 全フィードの記事を1本のリストにまとめておき、各ウォッチページではこれを1回走査するだけにする
+    watch_corpus = [
+        (url, source_data, entry)
+        for url, source_data in all_feeds_data.items() if source_data
+        for entry in source_data['entries']
+    ]
+    
     for watch_config in config.get('watches', []):
         target_filename = watch_config['filename']
         print(f"Building Watch Page: {target_filename}")
         
         watch_config['is_topic'] = True
         keywords = watch_config.get('keywords', [])
-        ng_keywords = watch_config.get('ng_keywords', [])
+        ng_automaton = get_ng_automaton(ng_automatons, ng_keywords_key(watch_config.get('ng_keywords', [])))
+        kw_automaton = build_keyword_automaton(keywords)
         
         watch_entries = []
         watch_topics = [] 
         site_data_dict = {} 
         seen_links = set()
+        kw_buckets = {kw: [] for kw in keywords}
+        # 新着件数は振り分けと同時に数えておき、後から全件を数え直さない
+        kw_new_counts = dict.fromkeys(keywords, 0)
+        
+        # 記事ごとに1回だけ走査し、合致した全キーワードの枠に振り分ける
+        # 複数のフィードに載っている同じリンクの記事は、NG判定を通って合致した最初の1件だけを使い、
+        # 以降の重複はNG判定・キーワード照合の前に飛ばす（リンクのない記事 '#' は重複とみなさない）
+        for url, source_data, entry in (watch_corpus if kw_automaton else []):
+            link = entry['link']
+            if link in seen_links:
+                continue
+            if is_ng_content(entry, ng_automaton):
+                continue
+            matched_keywords = match_keywords(kw_automaton, entry['_search_text'])
+            if not matched_keywords:
+                continue
+            if link != '#':
+                seen_links.add(link)
+            
+            e_copy = entry.copy()
+            e_copy['domain'] = source_data['domain']
+            e_copy['source_title'] = source_data['title']
+            
+            for kw in matched_keywords:
+                kw_buckets[kw].append(e_copy)
+                kw_new_counts[kw] += e_copy['is_new']
+            
+            watch_entries.append(e_copy)
+            
+            if url not in site_data_dict:
+                site_data_dict[url] = {
+                    'title': source_data['title'],
+                    'domain': source_data['domain'],
+                    'entries': [],
+                    'new_count': 0
+                }
+            site_data_dict[url]['entries'].append(e_copy)
+            site_data_dict[url]['new_count'] += e_copy['is_new']
         
         for kw in keywords:
-            kw_entries = []
-            for url, source_data in all_feeds_data.items():
-                if not source_data: continue
-                
-                for entry in source_data['entries']:
-                    if is_ng_content(entry, ng_keywords):
-                        continue
-                    text_to_search = (entry['title'] + entry['summary']).lower()
-                    if kw.lower() in text_to_search:
-                        e_copy = entry.copy()
-                        e_copy['favicon'] = source_data['favicon']
-                        e_copy['source_title'] = source_data['title']
-                        
-                        kw_entries.append(e_copy)
-                        
-                        if entry['link'] not in seen_links:
-                            seen_links.add(entry['link'])
-                            watch_entries.append(e_copy)
-                            
-                            if url not in site_data_dict:
-                                site_data_dict[url] = {
-                                    'title': source_data['title'],
-                                    'favicon': source_data['favicon'],
-                                    'entries': []
-                                }
-                            site_data_dict[url]['entries'].append(e_copy)
-                            
+            kw_entries = kw_buckets[kw]
             if kw_entries:
-                kw_entries.sort(key=lambda x: x['timestamp'], reverse=True)
+                kw_entries.sort(key=itemgetter('timestamp'), reverse=True)
                 watch_topics.append({
                     'title': f"キーワード: {kw}",
-                    'favicon': '',
+                    'domain': '',
                     'entries': kw_entries,
                     'total_count': len(kw_entries),
-                    'new_count': sum(1 for e in kw_entries if e['is_new']),
-                    'has_new': any(e['is_new'] for e in kw_entries)
+                    'new_count': kw_new_counts[kw],
+                    'has_new': kw_new_counts[kw] > 0
                 })
             
-        watch_entries.sort(key=lambda x: x['timestamp'], reverse=True)
+        watch_entries.sort(key=itemgetter('timestamp'), reverse=True)
         
         watch_feeds = []
         for url, data in site_data_dict.items():
-            data['entries'].sort(key=lambda x: x['timestamp'], reverse=True)
+            data['entries'].sort(key=itemgetter('timestamp'), reverse=True)
             watch_feeds.append({
                 'title': data['title'],
-                'favicon': data['favicon'],
+                'domain': data['domain'],
                 'entries': data['entries'],
                 'total_count': len(data['entries']),
-                'new_count': sum(1 for e in data['entries'] if e['is_new']),
-                'has_new': any(e['is_new'] for e in data['entries'])
+                'new_count': data['new_count'],
+                'has_new': data['new_count'] > 0
             })
 
         output_path = os.path.join(output_dir, target_filename)
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(template.render(
-                navigation=navigation,
-                current_page=watch_config,
-                entries=watch_entries,
-                feeds=watch_feeds,
-                topics=watch_topics, 
-                last_updated=now_str
-            ))
+        write_page(
+            template,
+            output_path,
+            current_page=watch_config,
+            entries=watch_entries,
+            feeds=watch_feeds,
+            topics=watch_topics
+        )
 
     print("All pages generated successfully.")
 